@@ -1,16 +1,87 @@
 import os 
 import re
+import json
+import time
+import threading
 
 from dataclasses import dataclass
+from functools import lru_cache
 from typing import Iterable, Dict, List, Tuple
-from collections import defaultdict
-from datetime import datetime
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 
-import matplotlib.pyplot as plt
+import matplotlib
+import numpy as np
+from matplotlib.figure import Figure
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.request import ACCEPT_ENCODING
+from urllib3.util.retry import Retry
+
+# Optional but recommended: orjson decodes large search bundles several times faster
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Optional: ijson parses search bundles incrementally as bytes arrive off the socket
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 
 FHIR_BASE = os.getenv("FHIR_BASE", "http://localhost:8080/fhir")
+_FHIR_BASE = FHIR_BASE.rstrip("/") + "/"  # normalized once; relative paths are appended to it
+
+# Accept header for opting into NDJSON (one resource per line) with Bundle JSON as fallback
+_ACCEPT_NDJSON = "application/fhir+ndjson, application/fhir+json;q=0.9"
+
+# Batch PNG export settings: decimate long lines before rasterizing and chunk huge paths
+_PNG_RC = {"path.simplify": True, "path.simplify_threshold": 1.0, "agg.path.chunksize": 10000}
+
+# Optional: set FHIR_CACHE to a file path to keep responses in a local SQLite cache
+# (requests-cache), so re-runs during iterative analysis don't refetch the same searches
+FHIR_CACHE = os.getenv("FHIR_CACHE")
+try:
+    from requests_cache import CachedSession
+except ImportError:
+    CachedSession = None
+
+# One pooled keep-alive session shared by every request (pagination included),
+# so follow-up pages reuse the open TCP connection instead of reconnecting.
+if FHIR_CACHE and CachedSession:
+    # Honours the server's Cache-Control; first pages and their `next` pages share one
+    # TTL so a cached first page never points at an already-expired paging handle
+    _SESSION = CachedSession(FHIR_CACHE, backend="sqlite", expire_after=3600,
+                             allowable_methods=("GET", "POST"), cache_control=True)
+else:
+    _SESSION = requests.Session()
+# Bundles compress well; brotli is only advertised when urllib3 can decode it (brotli installed)
+_SESSION.headers.update({"Accept": "application/fhir+json",
+                         "Accept-Encoding": "gzip, br" if "br" in ACCEPT_ENCODING else "gzip"})
+# Sized for the thread fan-outs (patients x categories / chart groups); 429s honour Retry-After.
+# POST is retried too: the only POSTs sent are `_search` and read-only batch Bundles
+_ADAPTER = HTTPAdapter(pool_connections=32, pool_maxsize=64,
+                       max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 502, 503, 504],
+                                         allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {"POST"},
+                                         raise_on_status=False))
+_SESSION.mount("http://", _ADAPTER)
+_SESSION.mount("https://", _ADAPTER)
+
+# Optional: set FHIR_MEMO=1 to also keep first-page search responses in memory, so repeated
+# searches within a session/notebook skip the network. Off by default, like FHIR_CACHE, since
+# clinical data can change under a long-lived kernel
+FHIR_MEMO = bool(os.getenv("FHIR_MEMO"))
+_MEMO_TTL = 3600                 # seconds after each fetch (matches FHIR_CACHE's expire_after)
+_MEMO_MAX_BYTES = 64 * 2**20     # bound on the summed response sizes; least recently used go first
+_MEMO = OrderedDict()           # (url, params key) -> (fetched_at, size, json)
+_MEMO_LOCK = threading.Lock()
+
+# Searches ask for large pages to save round trips; servers that reject a `_count` that big
+# (413, or 400/422 citing `_count`, rather than silently capping it) are retried once with this page size
+_FALLBACK_PAGE_SIZE = 200
 
 
 def fhir_get(path, params=None):
@@ -27,17 +98,175 @@ def fhir_get(path, params=None):
     Returns
     -------
     dict
-        Parsed JSON response from the FHIR server.
+        Parsed JSON response from the FHIR server. With FHIR_MEMO set, responses to
+        relative paths are memoized per (url, params) for _MEMO_TTL seconds, so treat
+        the result as read-only. Absolute URLs (`next` links, which carry server-side
+        paging handles) are always fetched.
 
     Raises
     ------
     requests.HTTPError
         If the request fails with a non-2xx HTTP status.
     """
-    url = path if path.startswith("http") else f"{FHIR_BASE.rstrip('/')}/{path.lstrip('/')}"
-    r = requests.get(url, params=params, timeout=60)
+    if not FHIR_MEMO or path.startswith("http"):
+        url = path if path.startswith("http") else _FHIR_BASE + path.lstrip("/")
+        return _fhir_get_uncached(url, params)[0]
+
+    url = _FHIR_BASE + path.lstrip("/")
+    key = (url, _params_key(params))
+    with _MEMO_LOCK:
+        hit = _MEMO.get(key)
+        if hit and time.monotonic() - hit[0] < _MEMO_TTL:
+            _MEMO.move_to_end(key)
+            return hit[2]
+    fetched_at = time.monotonic()
+    js, size = _fhir_get_uncached(url, params)  # failed requests raise, so they're never memoized
+    _memo_put(key, (fetched_at, size, js))
+    return js
+
+
+def _fhir_get_uncached(url, params):
+    """GET and decode; returns `(json, response size in bytes)`."""
+    r = _request("GET", url, params=params)
     r.raise_for_status()
-    return r.json()
+    return (orjson.loads(r.content) if orjson else r.json()), len(r.content)
+
+
+def _memo_put(key, entry):
+    """Store a memo entry, evicting expired then least recently used ones to stay under _MEMO_MAX_BYTES."""
+    if entry[1] > _MEMO_MAX_BYTES:
+        return
+    with _MEMO_LOCK:
+        _MEMO.pop(key, None)
+        _MEMO[key] = entry
+        now = time.monotonic()
+        for k in [k for k, (t, _, _) in _MEMO.items() if now - t >= _MEMO_TTL]:
+            del _MEMO[k]
+        total = sum(size for _, size, _ in _MEMO.values())
+        while total > _MEMO_MAX_BYTES:
+            _, (_, size, _) = _MEMO.popitem(last=False)
+            total -= size
+
+
+def _request(method, url, params=None, data=None, **kwargs):
+    """`_SESSION.request`, retried once with `_count=_FALLBACK_PAGE_SIZE` if the server rejects a larger page."""
+    r = _SESSION.request(method, url, params=params, data=data, timeout=60, **kwargs)
+    if r.status_code in (400, 413, 422) and _rejects_page_size(r.status_code, r.text):
+        smaller = (_smaller_page(params), _smaller_page(data))
+        if any(q is not None for q in smaller):
+            r.close()
+            r = _SESSION.request(method, url, params=smaller[0] or params, data=smaller[1] or data,
+                                 timeout=60, **kwargs)
+    return r
+
+
+def _rejects_page_size(status, detail):
+    """Whether an error response is the server refusing the requested `_count` (not a bad query)."""
+    return status == 413 or (status in (400, 422) and ("_count" in detail or "page size" in detail.lower()))
+
+
+def _smaller_page(q):
+    """Copy of search params (dict or key/value pairs) with `_count` cut to _FALLBACK_PAGE_SIZE, or None."""
+    pairs = list(q.items()) if isinstance(q, dict) else list(q or ())
+    if not any(k == "_count" and int(v) > _FALLBACK_PAGE_SIZE for k, v in pairs):
+        return None
+    return [(k, _FALLBACK_PAGE_SIZE if k == "_count" else v) for k, v in pairs]
+
+
+def _params_key(params):
+    """Canonical, hashable form of a params dict (list values expand to repeated keys)."""
+    pairs = []
+    for k, v in (params or {}).items():
+        for x in (v if isinstance(v, (list, tuple)) else [v]):
+            if x is not None:
+                pairs.append((k, str(x)))
+    return tuple(sorted(pairs))
+
+
+def _iter_bundle(r, links):
+    """Yield `entry[*].resource` from a streamed bundle response; its `link` items are appended to `links`."""
+    if "ndjson" in r.headers.get("Content-Type", ""):
+        # NDJSON: each line is a bare resource, no Bundle wrapper and no pagination links
+        for line in r.iter_lines():
+            if line:
+                yield orjson.loads(line) if orjson else json.loads(line)
+        return
+
+    if ijson is None:
+        bundle = orjson.loads(r.content) if orjson else r.json()
+        links.extend(bundle.get("link", []))
+        for e in bundle.get("entry", []):
+            yield e.get("resource", {})
+        return
+
+    # Feed each (already un-gzipped) chunk to two C-backed item parsers: one for
+    # the entries, one for the pagination links (HAPI writes `link` before `entry`)
+    resources, link_items = ijson.sendable_list(), ijson.sendable_list()
+    parsers = (ijson.items_coro(resources, "entry.item.resource", use_float=True),
+               ijson.items_coro(link_items, "link.item", use_float=True))
+    for chunk in r.iter_content(chunk_size=64 * 1024):
+        for p in parsers:
+            p.send(chunk)
+        yield from resources
+        del resources[:]
+    for p in parsers:
+        p.close()
+    yield from resources
+    links.extend(link_items)
+
+
+def fhir_iter_entries(path, params=None, data=None, ndjson=False):
+    """
+    Stream the resources of a FHIR search across all pages.
+
+    Parameters
+    ----------
+    path : str
+        Either a full URL or a relative FHIR path (e.g., 'Observation', 'Observation/_search').
+    params : dict, optional
+        Query parameters for the first (GET) request.
+    data : dict, optional
+        Form-encoded search parameters. When given, the first page is requested with
+        POST to `path` (e.g. 'Observation/_search'), so long parameter values such as
+        dozens of system-qualified LOINC tokens travel in the body and can't overflow
+        server/proxy URL length limits. List values are sent as repeated keys; None
+        values are dropped.
+    ndjson : bool, default=False
+        Ask for `application/fhir+ndjson` (falling back to Bundle JSON). NDJSON has
+        no Bundle/entry wrapper to parse, but it also carries no `next` links, so
+        only enable it for servers that stream the full result set that way.
+
+    Yields
+    ------
+    dict
+        Each `entry[*].resource` of every page, in server order.
+
+    Raises
+    ------
+    requests.HTTPError
+        If any page request fails with a non-2xx HTTP status.
+
+    Notes
+    -----
+    - `link.relation == "next"` pages are followed with GET until exhausted.
+    - With `ijson` installed, entries are parsed incrementally while the page is
+      still downloading, so a whole bundle never sits in memory next to the parsed
+      resources. Without it, each page is decoded in one go.
+    - NDJSON responses are detected by Content-Type (whether requested or not,
+      e.g. bulk `$export` output files) and parsed line by line.
+    """
+    url = path if path.startswith("http") else _FHIR_BASE + path.lstrip("/")
+    if data is not None:
+        data = {k: v for k, v in data.items() if v is not None}
+    method = "GET" if data is None else "POST"
+    headers = {"Accept": _ACCEPT_NDJSON} if ndjson else None
+    while url:
+        links = []
+        with _request(method, url, params=params, data=data, headers=headers, stream=True) as r:
+            r.raise_for_status()
+            yield from _iter_bundle(r, links)
+        url = next((l["url"] for l in links if l.get("relation") == "next"), None)
+        method, params, data = "GET", None, None
 
 
 # Optional but recommended for robust ISO parsing (handles timezone/no-T)
@@ -46,6 +275,18 @@ try:
 except Exception:
     dtparser = None
 
+# Optional: ciso8601 is a fast C parser for strict ISO 8601, which is what FHIR
+# dateTime/instant values are; anything it rejects falls back to the parsers above
+try:
+    from ciso8601 import parse_datetime as _ciso_parse
+except ImportError:
+    _ciso_parse = None
+
+
+# Shared read-only defaults for .get() chains in hot loops (no per-entry {} / [{}] allocations)
+_EMPTY: dict = {}
+_EMPTY_LIST: tuple = ()
+
 
 @dataclass(frozen=True)
 class SeriesSpec:
@@ -55,11 +296,14 @@ class SeriesSpec:
     unit_hint: str | None = None  # optional unit hint from your chartable list
 
 
-def _parse_when(obs: dict) -> datetime | None:
-    """Parse effective/issued into a datetime, robustly."""
-    t = obs.get("effectiveDateTime") or obs.get("issued")
-    if not t:
-        return None
+@lru_cache(maxsize=200_000)
+def _parse_iso(t: str) -> datetime | None:
+    """Parse an ISO 8601 timestamp string into a datetime, robustly (memoized: stamps repeat a lot)."""
+    if _ciso_parse:
+        try:
+            return _ciso_parse(t)
+        except ValueError:
+            pass
     try:
         if dtparser:
             return dtparser.parse(t)
@@ -69,6 +313,23 @@ def _parse_when(obs: dict) -> datetime | None:
         return None
 
 
+def _parse_when(obs: dict) -> datetime | None:
+    """Parse effective/issued into a datetime, robustly."""
+    t = obs.get("effectiveDateTime") or obs.get("issued")
+    return _parse_iso(t) if t else None
+
+
+
+
+def _to_datetime64(dts) -> np.ndarray:
+    """Convert datetimes to a naive-UTC datetime64[s] array (aware values are shifted to UTC)."""
+    return np.array([dt.astimezone(timezone.utc).replace(tzinfo=None) if dt.tzinfo else dt for dt in dts],
+                    dtype="datetime64[s]")
+
+
+# Compiled once: anything outside the filename whitelist, and runs of spaces/underscores
+_UNSAFE_FILENAME_CHARS = re.compile(r"[^a-zA-Z0-9 \-_.()+#]")
+_FILENAME_RUNS = re.compile(r"[ _]+")
 
 
 def _safe_filename(name: str) -> str:
@@ -85,18 +346,18 @@ def _safe_filename(name: str) -> str:
     if os.altsep:
         name = name.replace(os.altsep, "_")
     # Whitelist
-    allowed = set("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789 -_.()+#")
-    cleaned = "".join(ch if ch in allowed else "_" for ch in name)
+    cleaned = _UNSAFE_FILENAME_CHARS.sub("_", name)
     # Collapse runs of underscores/spaces and trim
-    cleaned = re.sub(r"[ _]+", "_", cleaned).strip(" _")
+    cleaned = _FILENAME_RUNS.sub("_", cleaned).strip(" _")
     return cleaned or "chart"
 
 
 def fetch_timeseries_for_codes(pid: str,
                                codes: Iterable[str],
-                               page_size: int = 200,
+                               page_size: int = 1000,
                                since: str | None = None,
-                               until: str | None = None) -> Dict[str, List[Tuple[datetime, float, str]]]:
+                               until: str | None = None,
+                               ndjson: bool = False) -> Dict[str, Tuple[np.ndarray, np.ndarray, np.ndarray]]:
     """
     Fetch numeric Observation points (valueQuantity) for a patient and a set of LOINC codes.
 
@@ -107,79 +368,110 @@ def fetch_timeseries_for_codes(pid: str,
     codes : iterable of str
         LOINC codes to fetch; both top-level Observation.valueQuantity and
         component.valueQuantity are collected.
-    page_size : int, default=200
-        Page size for Observation search.
+    page_size : int, default=1000
+        Page size for Observation search (retried at 200 if the server rejects it).
     since, until : str or None
         Optional ISO 8601 bounds, applied to Observation 'date' search param.
+    ndjson : bool, default=False
+        Request NDJSON instead of Bundles (see `fhir_iter_entries`).
 
     Returns
     -------
     dict
-        Mapping: code -> list of tuples (dt, value, unit_string)
+        Mapping: code -> (times, values, units), three parallel arrays sorted by time:
+        naive-UTC `datetime64[s]`, `float64`, and unit strings.
 
     Notes
     -----
     - Uses `_elements` projection to keep payload light.
     - Token filters are fully-qualified for LOINC (system+code).
+    - The first page is requested with POST `Observation/_search` so a long code
+      list can't overflow URL limits; subsequent `next` links are followed via GET.
+    - Entries are streamed via `fhir_iter_entries` rather than holding whole pages.
     """
     patient_ref = pid if str(pid).startswith("Patient/") else f"Patient/{pid}"
-    code_tokens = ",".join([f"http://loinc.org|{c}" for c in set(codes)])
+    codes = frozenset(codes)  # O(1) membership in the per-entry loop, whatever the caller passed
+    code_tokens = ",".join([f"http://loinc.org|{c}" for c in codes])
 
     fields = "id,code,subject,effectiveDateTime,issued,valueQuantity,component"
-    base_q = [f"patient={patient_ref}", f"_count={page_size}", f"_elements={fields}", f"code={code_tokens}"]
+    dates = []
     if since:
-        base_q.append(f"date=ge{since}")
+        dates.append(f"ge{since}")
     if until:
-        base_q.append(f"date=le{until}")
-    url = f"Observation?{'&'.join(base_q)}"
+        dates.append(f"le{until}")
+    params = {"patient": patient_ref, "_count": page_size, "_elements": fields,
+              "code": code_tokens, "date": dates or None}
+
+    # One flat struct of arrays for every point of every code; timestamps stay raw strings
+    # until paging is done, and the per-code split happens once, in NumPy
+    pt_codes: List[str] = []
+    pt_stamps: List[str] = []
+    pt_vals: List[float] = []
+    pt_units: List[str] = []
+    for o in fhir_iter_entries("Observation/_search", data=params, ndjson=ndjson):
+        t = o.get("effectiveDateTime") or o.get("issued")
+        if not t:
+            continue
 
-    out: Dict[str, List[Tuple[datetime, float, str]]] = defaultdict(list)
-    while True:
-        bundle = fhir_get(url, params={})
-        for e in bundle.get("entry", []):
-            o = e.get("resource", {})
-            dt = _parse_when(o)
-            if not dt:
+        # top-level numeric value
+        vq = o.get("valueQuantity")
+        if vq is not None and "value" in vq:
+            coding = (o.get("code") or _EMPTY).get("coding") or _EMPTY_LIST
+            ccode = coding[0].get("code") if coding else None
+            if ccode in codes:
+                pt_codes.append(ccode)
+                pt_stamps.append(t)
+                pt_vals.append(float(vq["value"]))
+                pt_units.append(vq.get("unit") or vq.get("code") or "")
+
+        # component numeric values
+        for comp in o.get("component") or _EMPTY_LIST:
+            vqc = comp.get("valueQuantity")
+            if vqc is None or "value" not in vqc:
                 continue
-
-            # top-level numeric value
-            vq = o.get("valueQuantity")
-            if vq is not None and "value" in vq:
-                cc = (o.get("code", {}).get("coding") or [{}])[0]
-                ccode = cc.get("code")
-                if ccode in codes:
-                    unit = vq.get("unit") or vq.get("code") or ""
-                    out[ccode].append((dt, float(vq["value"]), unit))
-
-            # component numeric values
-            for comp in o.get("component", []):
-                vqc = comp.get("valueQuantity")
-                if vqc is None or "value" not in vqc:
-                    continue
-                cc = (comp.get("code", {}).get("coding") or [{}])[0]
-                ccode = cc.get("code")
-                if ccode in codes:
-                    unit = vqc.get("unit") or vqc.get("code") or ""
-                    out[ccode].append((dt, float(vqc["value"]), unit))
-
-        nxt = next((l["url"] for l in bundle.get("link", []) if l.get("relation") == "next"), None)
-        if not nxt:
-            break
-        url = nxt  # absolute next link; params must be None/empty in fhir_get
-
-    # sort each series by time
-    for c in list(out.keys()):
-        out[c].sort(key=lambda t: t[0])
+            coding = (comp.get("code") or _EMPTY).get("coding") or _EMPTY_LIST
+            ccode = coding[0].get("code") if coding else None
+            if ccode in codes:
+                pt_codes.append(ccode)
+                pt_stamps.append(t)
+                pt_vals.append(float(vqc["value"]))
+                pt_units.append(vqc.get("unit") or vqc.get("code") or "")
+
+    out: Dict[str, Tuple[np.ndarray, np.ndarray, np.ndarray]] = {}
+    if not pt_codes:
+        return out
+
+    # parse each distinct timestamp once (panel results share stamps) and drop unparseable ones
+    stamps, t_inv = np.unique(np.array(pt_stamps), return_inverse=True)
+    parsed = [_parse_iso(str(t)) for t in stamps]
+    ok = np.array([dt is not None for dt in parsed], dtype=bool)
+    stamp_times = np.zeros(len(stamps), dtype="datetime64[s]")
+    stamp_times[ok] = _to_datetime64(dt for dt in parsed if dt is not None)
+    keep = ok[t_inv]
+
+    # one stable sort by (code, time), then each series is a contiguous slice
+    uniq, first_seen, c_inv = np.unique(np.array(pt_codes), return_index=True, return_inverse=True)
+    c_inv, times = c_inv[keep], stamp_times[t_inv[keep]]
+    order = np.lexsort((times, c_inv))
+    times = times[order]
+    vals = np.asarray(pt_vals, dtype=float)[keep][order]
+    units = np.asarray(pt_units, dtype=str)[keep][order]
+    ends = np.cumsum(np.bincount(c_inv, minlength=len(uniq)))
+    for i in np.argsort(first_seen):  # series in first-seen order
+        lo, hi = (ends[i - 1] if i else 0), ends[i]
+        out[str(uniq[i])] = (times[lo:hi], vals[lo:hi], units[lo:hi])
 
     return out
 
 
+@matplotlib.rc_context(_PNG_RC)
 def render_groups_to_png(pid: str,
                          groups: Dict[str, List[dict]],
                          out_dir: str = "./charts",
                          since: str | None = None,
                          until: str | None = None,
-                         dpi: int = 120) -> Dict[str, str]:
+                         dpi: int = 120,
+                         max_workers: int = 8) -> Dict[str, str]:
     """
     Render one PNG per chart group (single axes/figure, multiple lines allowed).
 
@@ -197,6 +489,9 @@ def render_groups_to_png(pid: str,
         Optional ISO bounds to restrict fetched Observations.
     dpi : int, default=120
         PNG resolution.
+    max_workers : int, default=8
+        Chart groups whose data is fetched in parallel (one search per group, sharing
+        the pooled session). Use 1 to fetch the union of codes in a single search.
 
     Returns
     -------
@@ -216,14 +511,28 @@ def render_groups_to_png(pid: str,
             series_meta[code] = SeriesSpec(code=code, label=label, unit_hint=unit_hint)
             needed_codes.add(code)
 
-    # 2) Fetch all time-series points for the union of codes
-    data_by_code = fetch_timeseries_for_codes(pid, needed_codes, since=since, until=until)
+    # 2) Fetch time-series points; (datetime64, float) arrays let matplotlib convert each
+    #    series in one vectorized pass. With several groups, each group's search runs
+    #    concurrently so long paginated histories don't download one page at a time.
+    group_codes = [codes for codes in ({s["code"] for s in sl} for sl in groups.values()) if codes]
+    if max_workers > 1 and len(group_codes) > 1:
+        data_by_code = {}
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(group_codes))) as ex:
+            for part in ex.map(lambda codes: fetch_timeseries_for_codes(pid, codes, since=since, until=until),
+                               group_codes):
+                data_by_code.update(part)
+    else:
+        data_by_code = fetch_timeseries_for_codes(pid, needed_codes, since=since, until=until)
 
     # 3) Render each chart group
+    # One figure (single axes) is built up front and cleared per chart rather than
+    # re-allocated; Figure() renders through Agg directly: no GUI backend, no pyplot state
+    fig = Figure(figsize=(8, 4.5))
+    ax = fig.subplots()  # one chart per figure; no subplots
+
     paths: Dict[str, str] = {}
     for title, series_list in groups.items():
-        # prepare the figure (single axes)
-        fig, ax = plt.subplots(figsize=(8, 4.5))  # one chart per figure; no subplots
+        ax.clear()
 
         plotted_any = False
         legend_labels = []
@@ -231,12 +540,10 @@ def render_groups_to_png(pid: str,
         for s in series_list:
             code = s["code"]
             meta = series_meta[code]
-            rows = data_by_code.get(code, [])
-            if not rows:
+            pts = data_by_code.get(code)
+            if pts is None or not len(pts[0]):
                 continue
-
-            xs = [dt for dt, _, _ in rows]
-            ys = [val for _, val, _ in rows]
+            xs, ys, _ = pts
 
             # Choose a series label: prefer human label; else fall back to code
             ser_label = meta.label or f"LOINC {code}"
@@ -248,7 +555,6 @@ def render_groups_to_png(pid: str,
 
         # If nothing plotted, skip file
         if not plotted_any:
-            plt.close(fig)
             continue
 
         # Titles & axes
@@ -267,7 +573,6 @@ def render_groups_to_png(pid: str,
         fname = _safe_filename(title) or "chart"
         path = os.path.join(out_dir, f"{fname}.png")
         fig.savefig(path, dpi=dpi, bbox_inches="tight")
-        plt.close(fig)
         paths[title] = path
 
     return paths
@@ -1,31 +1,118 @@
 import os
-
-from collections import defaultdict, Counter
-from datetime import datetime
-
+import re
+import json
+import time
+import threading
+
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+from functools import lru_cache, wraps
+from itertools import islice
+from urllib.parse import urlencode
+
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.request import ACCEPT_ENCODING
+from urllib3.util.retry import Retry
+
+# Optional but recommended: orjson decodes large search bundles several times faster
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Optional but recommended for robust ISO parsing (handles timezone/no-T)
+try:
+    from dateutil import parser as dtparser
+except Exception:
+    dtparser = None
+
+# Optional: ciso8601 parses ISO 8601 (the only format FHIR dateTime allows) in C;
+# anything it rejects falls back to the parsers above
+try:
+    from ciso8601 import parse_datetime as _ciso_parse
+except ImportError:
+    _ciso_parse = None
+
+# Optional: ijson parses search bundles incrementally while they download
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 FHIR_BASE = os.getenv("FHIR_BASE", "http://localhost:8080/fhir")
+_FHIR_BASE = FHIR_BASE.rstrip("/") + "/"  # normalized once; relative paths are appended to it
+
+# Accept header for opting into NDJSON (one resource per line) with Bundle JSON as fallback
+_ACCEPT_NDJSON = "application/fhir+ndjson, application/fhir+json;q=0.9"
+
+# Optional: set FHIR_CACHE to a file path to keep responses in a local SQLite cache
+# (requests-cache), so re-runs during iterative analysis don't refetch the same searches
+FHIR_CACHE = os.getenv("FHIR_CACHE")
+try:
+    from requests_cache import CachedSession
+except ImportError:
+    CachedSession = None
+
+# One pooled keep-alive session shared by every request (pagination included),
+# so follow-up pages reuse the open TCP connection instead of reconnecting.
+if FHIR_CACHE and CachedSession:
+    # Honours the server's Cache-Control; first pages and their `next` pages share one
+    # TTL so a cached first page never points at an already-expired paging handle
+    _SESSION = CachedSession(FHIR_CACHE, backend="sqlite", expire_after=3600,
+                             allowable_methods=("GET", "POST"), cache_control=True)
+else:
+    _SESSION = requests.Session()
+# Bundles compress well; brotli is only advertised when urllib3 can decode it (brotli installed)
+_SESSION.headers.update({"Accept": "application/fhir+json",
+                         "Accept-Encoding": "gzip, br" if "br" in ACCEPT_ENCODING else "gzip"})
+# Sized for the thread fan-outs (patients x categories / chart groups); 429s honour Retry-After.
+# POST is retried too: the only POSTs sent are `_search` and read-only batch Bundles
+_ADAPTER = HTTPAdapter(pool_connections=32, pool_maxsize=64,
+                       max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 502, 503, 504],
+                                         allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {"POST"},
+                                         raise_on_status=False))
+_SESSION.mount("http://", _ADAPTER)
+_SESSION.mount("https://", _ADAPTER)
+
+# Optional: set FHIR_MEMO=1 to also keep first-page search responses in memory, so repeated
+# searches within a session/notebook skip the network. Off by default, like FHIR_CACHE, since
+# clinical data can change under a long-lived kernel
+FHIR_MEMO = bool(os.getenv("FHIR_MEMO"))
+_MEMO_TTL = 3600                 # seconds after each fetch (matches FHIR_CACHE's expire_after)
+_MEMO_MAX_BYTES = 64 * 2**20     # bound on the summed response sizes; least recently used go first
+_MEMO = OrderedDict()           # (url, params key) -> (fetched_at, size, json)
+_MEMO_LOCK = threading.Lock()
+
+# Searches ask for large pages to save round trips; servers that reject a `_count` that big
+# (413, or 400/422 citing `_count`, rather than silently capping it) are retried once with this page size
+_FALLBACK_PAGE_SIZE = 200
 
 # Friendly names -> LOINC codes or categories
 SIGNAL_MAP = {
     # Blood Pressure panel (SBP/DBP in components)
-    "bp_panel": {"codes": ["85354-9", "55284-4"]},           # BP panel LOINC codes
+    "bp_panel": {"codes": ("85354-9", "55284-4")},           # BP panel LOINC codes
     # Individual vitals/labs
-    "sbp":      {"codes": ["8480-6"]},                        # Systolic BP
-    "dbp":      {"codes": ["8462-4"]},                        # Diastolic BP
-    "hr":       {"codes": ["8867-4"]},                        # Heart rate
-    "bmi":      {"codes": ["39156-5"]},                       # BMI
-    "chol":     {"codes": ["2093-3"]},                        # Total cholesterol
-    "hdl":      {"codes": ["2085-9"]},
-    "ldl":      {"codes": ["13457-7"]},
-    "tg":       {"codes": ["2571-8"]},                        # Triglycerides
-    "a1c":      {"codes": ["4548-4"]},                        # HbA1c
-    "glucose":  {"codes": ["2339-0"]},                        # Glucose (serum)
+    "sbp":      {"codes": ("8480-6",)},                       # Systolic BP
+    "dbp":      {"codes": ("8462-4",)},                       # Diastolic BP
+    "hr":       {"codes": ("8867-4",)},                       # Heart rate
+    "bmi":      {"codes": ("39156-5",)},                      # BMI
+    "chol":     {"codes": ("2093-3",)},                       # Total cholesterol
+    "hdl":      {"codes": ("2085-9",)},
+    "ldl":      {"codes": ("13457-7",)},
+    "tg":       {"codes": ("2571-8",)},                       # Triglycerides
+    "a1c":      {"codes": ("4548-4",)},                       # HbA1c
+    "glucose":  {"codes": ("2339-0",)},                       # Glucose (serum)
     # Category shortcuts
     "vitals":   {"category": "vital-signs"},
 }
 
+# Standard Observation category codes (http://terminology.hl7.org/CodeSystem/observation-category)
+OBSERVATION_CATEGORIES = ("social-history", "vital-signs", "imaging", "laboratory", "procedure",
+                          "survey", "exam", "therapy", "activity")
+
 
 def fhir_get(path, params=None):
     """
@@ -41,17 +128,355 @@ def fhir_get(path, params=None):
     Returns
     -------
     dict
-        Parsed JSON response from the FHIR server.
+        Parsed JSON response from the FHIR server. With FHIR_MEMO set, responses to
+        relative paths are memoized per (url, params) for _MEMO_TTL seconds, so treat
+        the result as read-only. Absolute URLs (`next` links, which carry server-side
+        paging handles) are always fetched.
 
     Raises
     ------
     requests.HTTPError
         If the request fails with a non-2xx HTTP status.
     """
-    url = path if path.startswith("http") else f"{FHIR_BASE.rstrip('/')}/{path.lstrip('/')}"
-    r = requests.get(url, params=params, timeout=60)
+    if not FHIR_MEMO or path.startswith("http"):
+        url = path if path.startswith("http") else _FHIR_BASE + path.lstrip("/")
+        return _fhir_get_uncached(url, params)[0]
+
+    url = _FHIR_BASE + path.lstrip("/")
+    key = (url, _params_key(params))
+    with _MEMO_LOCK:
+        hit = _MEMO.get(key)
+        if hit and time.monotonic() - hit[0] < _MEMO_TTL:
+            _MEMO.move_to_end(key)
+            return hit[2]
+    fetched_at = time.monotonic()
+    js, size = _fhir_get_uncached(url, params)  # failed requests raise, so they're never memoized
+    _memo_put(key, (fetched_at, size, js))
+    return js
+
+
+def _fhir_get_uncached(url, params):
+    """GET and decode; returns `(json, response size in bytes)`."""
+    r = _request("GET", url, params=params)
     r.raise_for_status()
-    return r.json()
+    return (orjson.loads(r.content) if orjson else r.json()), len(r.content)
+
+
+def _memo_put(key, entry):
+    """Store a memo entry, evicting expired then least recently used ones to stay under _MEMO_MAX_BYTES."""
+    if entry[1] > _MEMO_MAX_BYTES:
+        return
+    with _MEMO_LOCK:
+        _MEMO.pop(key, None)
+        _MEMO[key] = entry
+        now = time.monotonic()
+        for k in [k for k, (t, _, _) in _MEMO.items() if now - t >= _MEMO_TTL]:
+            del _MEMO[k]
+        total = sum(size for _, size, _ in _MEMO.values())
+        while total > _MEMO_MAX_BYTES:
+            _, (_, size, _) = _MEMO.popitem(last=False)
+            total -= size
+
+
+def _request(method, url, params=None, data=None, **kwargs):
+    """`_SESSION.request`, retried once with `_count=_FALLBACK_PAGE_SIZE` if the server rejects a larger page."""
+    r = _SESSION.request(method, url, params=params, data=data, timeout=60, **kwargs)
+    if r.status_code in (400, 413, 422) and _rejects_page_size(r.status_code, r.text):
+        smaller = (_smaller_page(params), _smaller_page(data))
+        if any(q is not None for q in smaller):
+            r.close()
+            r = _SESSION.request(method, url, params=smaller[0] or params, data=smaller[1] or data,
+                                 timeout=60, **kwargs)
+    return r
+
+
+def _rejects_page_size(status, detail):
+    """Whether an error response is the server refusing the requested `_count` (not a bad query)."""
+    return status == 413 or (status in (400, 422) and ("_count" in detail or "page size" in detail.lower()))
+
+
+def _smaller_page(q):
+    """Copy of search params (dict or key/value pairs) with `_count` cut to _FALLBACK_PAGE_SIZE, or None."""
+    pairs = list(q.items()) if isinstance(q, dict) else list(q or ())
+    if not any(k == "_count" and int(v) > _FALLBACK_PAGE_SIZE for k, v in pairs):
+        return None
+    return [(k, _FALLBACK_PAGE_SIZE if k == "_count" else v) for k, v in pairs]
+
+
+def _params_key(params):
+    """Canonical, hashable form of a params dict (list values expand to repeated keys)."""
+    pairs = []
+    for k, v in (params or {}).items():
+        for x in (v if isinstance(v, (list, tuple)) else [v]):
+            if x is not None:
+                pairs.append((k, str(x)))
+    return tuple(sorted(pairs))
+
+
+def fhir_batch(urls):
+    """
+    Run several FHIR GET requests in a single round trip as a `batch` Bundle.
+
+    Parameters
+    ----------
+    urls : list of str
+        Relative request URLs, e.g. 'Observation?patient=Patient/123&category=laboratory'.
+
+    Returns
+    -------
+    list of dict
+        The `resource` of each batch response entry, in request order (for searches,
+        the first page of each result as a searchset Bundle).
+
+    Raises
+    ------
+    requests.HTTPError
+        If the batch itself, or any entry in it, fails with a non-2xx status. For a
+        failed entry, the error carries `entry_status` (int or None) and `entry_detail`
+        (the entry's OperationOutcome, as text).
+    """
+    body = {"resourceType": "Bundle", "type": "batch",
+            "entry": [{"request": {"method": "GET", "url": u}} for u in urls]}
+    payload = {"data": orjson.dumps(body)} if orjson else {"json": body}
+    r = _SESSION.post(FHIR_BASE, headers={"Content-Type": "application/fhir+json"}, timeout=60, **payload)
+    r.raise_for_status()
+    js = orjson.loads(r.content) if orjson else r.json()
+    out = []
+    for u, e in zip(urls, js.get("entry", [])):
+        status = e.get("response", {}).get("status", "")
+        if not status.startswith("2"):
+            err = requests.HTTPError(f"Batch entry failed ({status or 'no status'}): {u}", response=r)
+            err.entry_status = int(status[:3]) if status[:3].isdigit() else None
+            err.entry_detail = str(e.get("response", {}).get("outcome") or e.get("resource") or "")
+            raise err
+        out.append(e.get("resource", {}))
+    return out
+
+
+def _drain_search(bundle, count):
+    """Collect resources from a search bundle, following `next` links until `count` is reached."""
+    out = []
+    while True:
+        out.extend([e["resource"] for e in bundle.get("entry", [])])
+        nxt = next((l["url"] for l in bundle.get("link", []) if l["relation"] == "next"), None)
+        if not nxt or len(out) >= count:
+            return out
+        bundle = fhir_get(nxt)  # follow absolute next link
+
+
+def _iter_bundle(r, links):
+    """Yield `entry[*].resource` from a streamed bundle response; its `link` items are appended to `links`."""
+    if "ndjson" in r.headers.get("Content-Type", ""):
+        # NDJSON: each line is a bare resource, no Bundle wrapper and no pagination links
+        for line in r.iter_lines():
+            if line:
+                yield orjson.loads(line) if orjson else json.loads(line)
+        return
+
+    if ijson is None:
+        bundle = orjson.loads(r.content) if orjson else r.json()
+        links.extend(bundle.get("link", []))
+        for e in bundle.get("entry", []):
+            yield e.get("resource", {})
+        return
+
+    # Feed each (already un-gzipped) chunk to two C-backed item parsers: one for
+    # the entries, one for the pagination links (HAPI writes `link` before `entry`)
+    resources, link_items = ijson.sendable_list(), ijson.sendable_list()
+    parsers = (ijson.items_coro(resources, "entry.item.resource", use_float=True),
+               ijson.items_coro(link_items, "link.item", use_float=True))
+    for chunk in r.iter_content(chunk_size=64 * 1024):
+        for p in parsers:
+            p.send(chunk)
+        yield from resources
+        del resources[:]
+    for p in parsers:
+        p.close()
+    yield from resources
+    links.extend(link_items)
+
+
+def fhir_iter_entries(path, params=None, data=None, ndjson=False):
+    """
+    Stream the resources of a FHIR search across all pages.
+
+    Parameters
+    ----------
+    path : str
+        Either a full URL or a relative FHIR path (e.g., 'Observation', 'Observation/_search').
+    params : dict, optional
+        Query parameters for the first (GET) request.
+    data : dict, optional
+        Form-encoded search parameters. When given, the first page is requested with
+        POST to `path` (e.g. 'Observation/_search'), so long parameter values such as
+        dozens of system-qualified LOINC tokens travel in the body and can't overflow
+        server/proxy URL length limits. List values are sent as repeated keys; None
+        values are dropped.
+    ndjson : bool, default=False
+        Ask for `application/fhir+ndjson` (falling back to Bundle JSON). NDJSON has
+        no Bundle/entry wrapper to parse, but it also carries no `next` links, so
+        only enable it for servers that stream the full result set that way.
+
+    Yields
+    ------
+    dict
+        Each `entry[*].resource` of every page, in server order.
+
+    Raises
+    ------
+    requests.HTTPError
+        If any page request fails with a non-2xx HTTP status.
+
+    Notes
+    -----
+    - `link.relation == "next"` pages are followed with GET until exhausted.
+    - With `ijson` installed, entries are parsed incrementally while the page is
+      still downloading, so a whole bundle never sits in memory next to the parsed
+      resources. Without it, each page is decoded in one go.
+    - NDJSON responses are detected by Content-Type (whether requested or not,
+      e.g. bulk `$export` output files) and parsed line by line.
+    """
+    url = path if path.startswith("http") else _FHIR_BASE + path.lstrip("/")
+    if data is not None:
+        data = {k: v for k, v in data.items() if v is not None}
+    method = "GET" if data is None else "POST"
+    headers = {"Accept": _ACCEPT_NDJSON} if ndjson else None
+    while url:
+        links = []
+        with _request(method, url, params=params, data=data, headers=headers, stream=True) as r:
+            r.raise_for_status()
+            yield from _iter_bundle(r, links)
+        url = next((l["url"] for l in links if l.get("relation") == "next"), None)
+        method, params, data = "GET", None, None
+
+
+def fhir_count(resource, params=None):
+    """
+    Return the total number of matches for a FHIR search without downloading entries.
+
+    Parameters
+    ----------
+    resource : str
+        Relative FHIR search path (e.g., 'Observation', 'Patient').
+    params : dict, optional
+        Search parameters; `_summary=count` is added.
+
+    Returns
+    -------
+    int or None
+        `Bundle.total` as reported by the server, or None if it omits the total.
+    """
+    bundle = fhir_get(resource, params={**(params or {}), "_summary": "count"})
+    return bundle.get("total")
+
+
+@lru_cache(maxsize=200_000)
+def _parse_iso(t: str) -> datetime | None:
+    """Parse an ISO 8601 timestamp string into a datetime, robustly (memoized: stamps repeat a lot)."""
+    if _ciso_parse:
+        try:
+            return _ciso_parse(t)
+        except ValueError:
+            pass
+    try:
+        if dtparser:
+            return dtparser.parse(t)
+        # minimal fallback: accept 'Z' or with offset
+        return datetime.fromisoformat(t.replace("Z", "+00:00"))
+    except Exception:
+        return None
+
+
+def _to_datetime64(dts) -> np.ndarray:
+    """Convert datetimes to a naive-UTC datetime64[s] array (aware values are shifted to UTC)."""
+    return np.array([dt.astimezone(timezone.utc).replace(tzinfo=None) if dt.tzinfo else dt for dt in dts],
+                    dtype="datetime64[s]")
+
+
+_FHIR_ID = re.compile(r"[A-Za-z0-9\-.]{1,64}")  # FHIR logical id syntax
+
+
+def resolve_patient_ref(identifier_or_id: str) -> str:
+    """
+    Resolve a patient id or business identifier (e.g. an MRN) to a `Patient/{id}` reference.
+
+    Parameters
+    ----------
+    identifier_or_id : str
+        A `Patient/{id}` reference (returned as-is), a logical id, or an identifier
+        token (`value` or `system|value`) as accepted by `Patient?identifier=`.
+
+    Returns
+    -------
+    str
+        The `Patient/{id}` reference.
+
+    Raises
+    ------
+    ValueError
+        If no Patient matches, or if the value is both the logical id of one Patient
+        and an identifier of another.
+    requests.HTTPError
+        If a lookup fails with a non-2xx HTTP status.
+
+    Notes
+    -----
+    - Values with logical-id syntax are looked up by `_id` and by `identifier`
+      (MRNs are often id-shaped too); other values by `identifier` only.
+    - Lookups are plain GET searches, memoized for the session.
+    - The per-patient helpers skip this for id-shaped values: they query `Patient/{id}`
+      directly and only fall back to an identifier lookup if no Patient has that id.
+    """
+    if identifier_or_id.startswith("Patient/"):
+        return identifier_or_id
+    by_id = _patient_ref_by_id(identifier_or_id) if _FHIR_ID.fullmatch(identifier_or_id) else None
+    by_identifier = _patient_ref_by_identifier(identifier_or_id)
+    if by_id and by_identifier and by_id != by_identifier:
+        raise ValueError(f"{identifier_or_id!r} is the id of {by_id} but an identifier of {by_identifier}")
+    if not (ref := by_id or by_identifier):
+        raise ValueError(f"No Patient found for {identifier_or_id!r}")
+    return ref
+
+
+@lru_cache(maxsize=1024)
+def _patient_ref_by_id(pid: str) -> str | None:
+    """`Patient/{pid}` if a Patient with that logical id exists, else None."""
+    bundle = fhir_get("Patient", params={"_id": pid, "_elements": "id"})
+    return f"Patient/{pid}" if bundle.get("entry") else None
+
+
+@lru_cache(maxsize=1024)
+def _patient_ref_by_identifier(identifier: str) -> str | None:
+    """`Patient/{id}` of the first Patient matching `Patient?identifier={identifier}`, or None."""
+    bundle = fhir_get("Patient", params={"identifier": identifier, "_elements": "id"})
+    for e in bundle.get("entry", []):
+        return f"Patient/{e['resource']['id']}"
+    return None
+
+
+def _per_patient(func):
+    """
+    Decorator for the public per-patient helpers: accept a `pid` that is a `Patient/{id}`
+    reference, a logical id or an identifier (see `resolve_patient_ref`).
+
+    An id-shaped `pid` is used as `Patient/{pid}` straight away, with no lookup. Only if
+    that finds nothing *and* no Patient has that id is it retried as an identifier; an
+    existing Patient with no matching data keeps its empty result. Pre-fetched `obs`
+    are analyzed as given.
+    """
+    @wraps(func)
+    def wrapper(pid, *args, **kwargs):
+        if kwargs.get("obs") is not None:
+            return func(pid, *args, **kwargs)
+        pid = str(pid)
+        if pid.startswith("Patient/") or not _FHIR_ID.fullmatch(pid):
+            return func(resolve_patient_ref(pid), *args, **kwargs)
+        out = func(f"Patient/{pid}", *args, **kwargs)
+        if out or _patient_ref_by_id(pid):
+            return out
+        alt = _patient_ref_by_identifier(pid)
+        return func(alt, *args, **kwargs) if alt else out
+    return wrapper
 
 
 def list_patients(count=50):
@@ -80,16 +505,21 @@ def list_patients(count=50):
 
 
 
-def get_observation_categories_for_patient(pid, count=1000):
+@_per_patient
+def get_observation_categories_for_patient(pid, count=1000, page_size=1000):
     """
     Retrieve all unique Observation categories available for a given patient.
 
     Parameters
     ----------
     pid : str
-        The patient ID (e.g., "12345") for which to list Observation categories.
+        The patient ID (e.g., "12345") for which to list Observation categories, with or
+        without the "Patient/" prefix, or an identifier such as an MRN (see `resolve_patient_ref`).
     count : int, default=1000
         Maximum number of Observation resources to inspect before stopping.
+    page_size : int, default=1000
+        Number of Observation resources to request per page (only `category` is
+        requested, so entries are small).
 
     Returns
     -------
@@ -111,37 +541,39 @@ def get_observation_categories_for_patient(pid, count=1000):
     >>> list_observation_categories("12345")
     {'vital-signs', 'laboratory', 'social-history'}
     """
-    out = []
+    cats = set()
+    seen = 0
     url = "Observation"
-    params = {"patient": pid, "_count": 200}
+    params = {"patient": pid, "_count": min(page_size, count), "_elements": "category"}
     while True:
         js = fhir_get(url, params=params)
-        out.extend([e["resource"] for e in js.get("entry", [])])
+        # single pass: pull category tokens straight out of each entry, no buffered copy
+        for e in js.get("entry", []):
+            seen += 1
+            for cat in e["resource"].get("category", []):
+                coding = cat.get("coding", [])
+                for c in coding:
+                    if code := c.get("code"):
+                        cats.add(code)
+                if not coding and (txt := cat.get("text")):
+                    cats.add(txt)
         nxt = next((link["url"] for link in js.get("link", []) if link["relation"] == "next"), None)
-        if not nxt or len(out) >= count:
+        if not nxt or seen >= count:
             break
         url, params = nxt, None
-
-    cats = set()
-    for obs in out:
-        for cat in obs.get("category", []):
-            coding = cat.get("coding", [])
-            for c in coding:
-                if code := c.get("code"):
-                    cats.add(code)
-            if not coding and (txt := cat.get("text")):
-                cats.add(txt)
     return cats
 
 
-def get_observations_for_patient(pid, codes=None, category=None, count=2000):
+@_per_patient
+def get_observations_for_patient(pid, codes=None, category=None, count=2000, elements=None, page_size=1000):
     """
     Retrieve Observation resources for a given patient from a FHIR server.
 
     Parameters
     ----------
     pid : str
-        The patient ID (e.g., "12345") for which to retrieve observations.
+        The patient ID (e.g., "12345") for which to retrieve observations, with or without
+        the "Patient/" prefix, or an identifier such as an MRN (see `resolve_patient_ref`).
     codes : list of str, optional
         A list of LOINC or other Observation codes to filter results by.
         Example: ["2093-3", "2085-9"] for cholesterol panels.
@@ -151,6 +583,11 @@ def get_observations_for_patient(pid, codes=None, category=None, count=2000):
         or "survey". If provided, limits the search to that category.
     count : int, default=2000
         Maximum number of Observation resources to retrieve before stopping.
+    elements : str, optional
+        Comma-separated `_elements` projection (e.g. "code,valueQuantity,effectiveDateTime")
+        so the server omits narrative/meta and other unused fields.
+    page_size : int, default=1000
+        Number of Observation resources to request per page (never more than `count`).
 
     Returns
     -------
@@ -178,29 +615,24 @@ def get_observations_for_patient(pid, codes=None, category=None, count=2000):
     >>> observations[0]["resourceType"]
     'Observation'
     """
-    params = {"patient": pid, "_count": 200}
+    params = {"patient": pid, "_count": min(page_size, count)}
     if codes:
         params["code"] = ",".join(codes)
     if category:
         params["category"] = category
-    out = []
-    url = "Observation"
-    while True:
-        js = fhir_get(url, params=params)
-        out.extend([e["resource"] for e in js.get("entry", [])])
-        nxt = next((l["url"] for l in js.get("link", []) if l["relation"] == "next"), None)
-        if not nxt or len(out) >= count:
-            break
-        url, params = nxt, None  # follow absolute next link
-    return out
+    if elements:
+        params["_elements"] = elements
+    return list(islice(fhir_iter_entries("Observation", params=params), count))
 
 
 
+@_per_patient
 def get_observation_counts_for_patient(pid: str,
                                        sample: int = 2000,
-                                       page_size: int = 200,
+                                       page_size: int = 1000,
                                        since: str | None = None,
-                                       until: str | None = None) -> dict[str, int]:
+                                       until: str | None = None,
+                                       categories: list[str] | None = None) -> dict[str, int]:
     """
     Count Observation resources per Category for a given patient.  Note however that categories
     are still quite broad (e.g. "vital-signs", "laboratory", "imaging", etc).
@@ -209,32 +641,41 @@ def get_observation_counts_for_patient(pid: str,
     Parameters
     ----------
     pid : str
-        Patient ID (e.g., "12345"). Accepts with or without the "Patient/" prefix.
+        Patient ID (e.g., "12345"), with or without the "Patient/" prefix, or a patient
+        identifier such as an MRN (see `resolve_patient_ref`).
     sample : int, default=2000
-        Maximum number of Observation resources to scan before stopping. Acts as a
-        performance guardrail. Set higher to approach a full count.
-    page_size : int, default=200
-        Number of Observation resources to request per page.
+        Maximum number of Observation resources to scan before stopping when falling
+        back to a client-side scan. Acts as a performance guardrail.
+    page_size : int, default=1000
+        Number of Observation resources to request per page in the fallback scan. With
+        `_elements=category` each entry is tiny, so large pages mostly save round trips
+        (servers cap it at their own maximum).
     since : str or None, default=None
         Optional lower bound on Observation date (ISO 8601). Applies as `date=ge{since}`.
     until : str or None, default=None
         Optional upper bound on Observation date (ISO 8601). Applies as `date=le{until}`.
+    categories : list of str, optional
+        Category tokens to count. Defaults to OBSERVATION_CATEGORIES (the standard
+        HL7 observation-category codes); pass local codes explicitly if your server uses them.
 
     Returns
     -------
     dict[str, int]
         Mapping from category token to count, e.g.
         `{"vital-signs": 128, "laboratory": 412, "imaging": 9}`.
+        Categories with no matches are omitted.
 
     Notes
     -----
-    - Uses `_elements=category` to minimize payload (avoids `_summary=data` quirks).
+    - Counts are computed server-side: one `_summary=count&_total=accurate` request
+      for the patient, then one per category (issued concurrently). No entries are
+      downloaded.
+    - If the server omits `Bundle.total`, or none of the default categories match
+      although the patient has Observations, falls back to scanning up to `sample`
+      entries with `_elements=category` (tallying `coding.code`, or `category.text`
+      when there is no code). With explicit `categories`, zero counts are returned
+      as-is and the scan only tallies those categories.
     - An Observation can have multiple categories; each category is counted.
-    - If a category has no `coding.code`, falls back to `category.text`.
-    - For an exact total regardless of volume, either:
-        (a) increase `sample` sufficiently, or
-        (b) run a second pass per discovered category using
-            `/Observation?...&category=<cat>&_summary=count&_total=accurate`.
 
     Examples
     --------
@@ -244,61 +685,60 @@ def get_observation_counts_for_patient(pid: str,
     >>> get_observation_counts_by_category("60816", since="2020-01-01", until="2025-10-10")
     {'vital-signs': 87, 'laboratory': 156}
     """
-    if isinstance(pid, int):
-        pid = str(pid)
-    patient_ref = pid if pid.startswith("Patient/") else f"Patient/{pid}"
-    params = {"patient": patient_ref, "_count": page_size, "_elements": "category"}
-    # Add date filters (allow both ge/le by repeating 'date' in the URL)
-    url = "Observation"
-    q = [f"patient={patient_ref}", f"_count={page_size}", "_elements=category"]
-    if since:
-        q.append(f"date=ge{since}")
-    if until:
-        q.append(f"date=le{until}")
-    if len(q) > 3:  # we added date filters; construct URL to preserve duplicate keys
-        url = f"Observation?{'&'.join(q)}"
-        params = {}  # already encoded in URL
+    patient_ref = pid if str(pid).startswith("Patient/") else f"Patient/{pid}"
 
-    counts: dict[str, int] = {}
-    seen = 0
+    # --- Server-side counts: no entries are materialized ---
+    base = {"patient": patient_ref, "_total": "accurate"}
+    dates = [f"ge{since}"] * bool(since) + [f"le{until}"] * bool(until)
+    if dates:
+        base["date"] = dates
+    total = fhir_count("Observation", base)
+    if total == 0:
+        return {}
+    if total is not None:
+        cats = categories or OBSERVATION_CATEGORIES
+        with ThreadPoolExecutor(max_workers=min(len(cats), 8)) as ex:
+            totals = list(ex.map(lambda cat: fhir_count("Observation", {**base, "category": cat}), cats))
+        # all-zero totals only trigger the scan for the default list (the server may use local codes)
+        if None not in totals and (categories or any(totals)):
+            return {cat: n for cat, n in zip(cats, totals) if n}
+
+    # --- Fallback: tally categories client-side ---
+    params = {"patient": patient_ref, "_count": min(page_size, sample), "_elements": "category"}
+    if dates:
+        params["date"] = dates  # a list repeats the key, so ge/le both apply
 
-    while True:
-        js = fhir_get(url, params=params if isinstance(url, str) else None)
-        for e in js.get("entry", []):
-            obs = e.get("resource", {})
-            # collect category tokens for this Observation
-            toks = set()
-            for cat in obs.get("category", []):
-                codings = cat.get("coding", [])
-                if codings:
-                    for c in codings:
-                        code = (c.get("code") or "").strip()
-                        if code:
-                            toks.add(code)
-                else:
-                    txt = (cat.get("text") or "").strip()
-                    if txt:
-                        toks.add(txt)
-            # increment counts
-            for t in toks:
-                counts[t] = counts.get(t, 0) + 1
+    counts: dict[str, int] = {}
+    wanted = set(categories) if categories else None
 
-            seen += 1
-            if seen >= sample:
-                break
-        if seen >= sample:
-            break
-        nxt = next((l["url"] for l in js.get("link", []) if l.get("relation") == "next"), None)
-        if not nxt:
-            break
-        url, params = nxt, None
+    # stop reading (and parsing) as soon as `sample` entries have been tallied
+    for obs in islice(fhir_iter_entries("Observation", params=params), sample):
+        # collect category tokens for this Observation
+        toks = set()
+        for cat in obs.get("category", []):
+            codings = cat.get("coding", [])
+            if codings:
+                for c in codings:
+                    code = (c.get("code") or "").strip()
+                    if code:
+                        toks.add(code)
+            else:
+                txt = (cat.get("text") or "").strip()
+                if txt:
+                    toks.add(txt)
+        if wanted is not None:
+            toks &= wanted
+        # increment counts
+        for t in toks:
+            counts[t] = counts.get(t, 0) + 1
 
     return counts
 
 
 
 
-def get_patientids_with_observations(category: str | None = None, page_size: int = 200, max_patients: int | None = None) -> list[str]:
+def get_patientids_with_observations(category: str | None = None, page_size: int | None = None, max_patients: int | None = None,
+                                     count_only: bool = False) -> list[str] | int | None:
     """
     Return Patient IDs who have at least one Observation in a given category.
 
@@ -307,15 +747,21 @@ def get_patientids_with_observations(category: str | None = None, page_size: int
     category : str or None, default=None
         Observation category token, e.g. ``"laboratory"``, ``"vital-signs"``, ``"imaging"``, ``"survey"``, etc.
         If None, retrieves patients who have *any* Observation.
-    page_size : int, default=200
+    page_size : int or None, default=None
         Number of Patient resources to request per page. Controls paging size of *Patients*, not number of Observations.
+        If None, the page is sized to `max_patients` (up to 1000) so a bounded request is a single round trip,
+        and defaults to 1000 otherwise.
     max_patients : int or None, default=None
         Optional hard cap on how many Patient IDs to return across all pages. If None, retrieves all pages.
+    count_only : bool, default=False
+        If True, return only the cohort size (`Bundle.total` from a `_summary=count` search) without
+        downloading any Patient resources.
 
     Returns
     -------
-    list of str
-        Patient IDs (e.g., ``["12345", "67890", ...]``) who have at least one Observation in the specified category.
+    list of str, or int or None if `count_only`
+        Patient IDs (e.g., ``["12345", "67890", ...]``) who have at least one Observation in the specified category;
+        with `count_only`, the number of such Patients (None if the server omits the total).
 
     Notes
     -----
@@ -332,12 +778,19 @@ def get_patientids_with_observations(category: str | None = None, page_size: int
     """
     ids: list[str] = []
     url = "Patient"
-    params = {"_elements": "id", "_count": page_size}
+    params = {"_elements": "id"}
     if category:
         params["_has:Observation:subject:category"] = category
     else:
         url = "/Patient?_has:Observation:patient:_id"  # any observation
 
+    if count_only:
+        return fhir_count(url, params)
+
+    if page_size is None:
+        page_size = min(max_patients, 1000) if max_patients is not None else 1000
+    params["_count"] = page_size
+
     while True:
         bundle = fhir_get(url, params=params if isinstance(url, str) else None)
         for e in bundle.get("entry", []):
@@ -354,19 +807,40 @@ def get_patientids_with_observations(category: str | None = None, page_size: int
     return ids
 
 
+def _iter_points(o):
+    """Yield `(code, display, unit)` for each numeric value of an Observation: its own, then its components'."""
+    for part in (o, *(o.get("component") or ())):
+        vq = part.get("valueQuantity")
+        if vq and "value" in vq:
+            cc = (part.get("code", {}).get("coding") or [{}])[0]
+            if code := cc.get("code"):
+                yield code, cc.get("display"), vq.get("unit") or vq.get("code") or ""
+
+
+def _by_frequency(values):
+    """Distinct values, most frequent first (ties: first seen); no Counter when all are equal (the usual case)."""
+    if not values or values.count(values[0]) == len(values):
+        return values[:1]
+    return [v for v, _ in Counter(values).most_common()]
+
+
+@_per_patient
 def get_chartable_codes_for_patient(pid: str,
                                     min_points: int = 5,
                                     min_span_days: int = 7,
                                     sample: int = 5000,
                                     obs: list[dict] | None = None,
-                                    categories: list[str] | None = None) -> list[dict]:
+                                    categories: list[str] | None = None,
+                                    only_chartable: bool = False,
+                                    page_size: int = 1000) -> list[dict]:
     """
     Identify chartable Observation series (by code) for a patient, with labels/units.
 
     Parameters
     ----------
     pid : str
-        Patient ID (with or without 'Patient/' prefix).
+        Patient ID (with or without 'Patient/' prefix) or identifier such as an MRN
+        (see `resolve_patient_ref`; not looked up when `obs` is given).
     min_points : int, default=5
         Minimum number of numeric points required per code.
     min_span_days : int, default=7
@@ -379,6 +853,14 @@ def get_chartable_codes_for_patient(pid: str,
     categories : list[str] or None, default=None
         If `obs` is None, restrict fetching to these Observation categories
         (e.g., ["laboratory","vital-signs"]). If None, fetch all categories.
+    only_chartable : bool, default=False
+        If True and `obs` is None, fetch only Observations whose code is in
+        CHARTABLE_CODES (the codes `group_chartables` has dedicated charts for, plus
+        SIGNAL_MAP) with a single search: LOINC-qualified `code=` tokens, ORed with
+        commas, combined with `categories` (also ORed) when given. Codes outside that
+        set are never downloaded, so they can't be reported.
+    page_size : int, default=1000
+        Number of Observation resources to request per page when fetching.
 
     Returns
     -------
@@ -391,83 +873,307 @@ def get_chartable_codes_for_patient(pid: str,
           - span_days: int
         Sorted by count descending.
     """
-    patient_ref = pid if str(pid).startswith("Patient/") else f"Patient/{pid}"
-
-    # --- Fetch if not provided ---
+    # --- Fetch if not provided (only the fields the aggregation reads) ---
     if obs is None:
-        if categories:
-            obs = []
-            for cat in categories:
-                obs.extend(get_observations_for_patient(patient_ref, category=cat, count=sample))
+        patient_ref = pid if str(pid).startswith("Patient/") else f"Patient/{pid}"
+        fields = "code,component,valueQuantity,effectiveDateTime,issued"
+        if only_chartable:
+            # one search instead of one per category; system|code tokens hit the token index directly
+            obs = get_observations_for_patient(patient_ref,
+                                               codes=[f"http://loinc.org|{c}" for c in sorted(CHARTABLE_CODES)],
+                                               category=",".join(categories) if categories else None,
+                                               count=sample, elements=fields, page_size=page_size)
+        elif categories:
+            # a single batch round trip returns the first page of every category search;
+            # only categories with more pages need further requests
+            def _urls(n):
+                return [f"Observation?{urlencode({'patient': patient_ref, 'category': cat, '_count': n, '_elements': fields})}"
+                        for cat in categories]
+            n = min(page_size, sample)
+            try:
+                bundles = fhir_batch(_urls(n))
+            except requests.HTTPError as err:
+                # resend only when an entry was refused for its page size, not for any failure
+                if n <= _FALLBACK_PAGE_SIZE or not _rejects_page_size(getattr(err, "entry_status", None),
+                                                                      getattr(err, "entry_detail", "")):
+                    raise
+                bundles = fhir_batch(_urls(_FALLBACK_PAGE_SIZE))
+            obs = [o for bundle in bundles for o in _drain_search(bundle, sample)]
         else:
-            obs = get_observations_for_patient(patient_ref, count=sample)
+            obs = get_observations_for_patient(patient_ref, count=sample, elements=fields, page_size=page_size)
 
     # --- Aggregate numeric points by code (including components) ---
-    def _parse_dt(o):
+    pt_codes = []                       # one entry per numeric point (flat struct of arrays) ...
+    pt_stamps = []                      # ... its raw ISO 8601 timestamp ...
+    pt_labels = []                      # ... display string (or None) ...
+    pt_units = []                       # ... and unit string ("" if none)
+
+    for o in obs:
         t = o.get("effectiveDateTime") or o.get("issued")
         if not t:
-            return None
-        try:
-            return datetime.fromisoformat(t.replace("Z", "+00:00"))
-        except Exception:
-            return None
+            continue
+        for code, disp, unit in _iter_points(o):
+            pt_codes.append(code)
+            pt_stamps.append(t)
+            pt_labels.append(disp)
+            pt_units.append(unit)
+
+    if not pt_codes:
+        return []
+
+    # --- Parse each distinct timestamp once (panels/components share them) into epoch seconds ---
+    stamps, t_inv = np.unique(np.array(pt_stamps), return_inverse=True)
+    parsed = [_parse_iso(str(t)) for t in stamps]
+    ok = np.array([dt is not None for dt in parsed])
+    secs = np.zeros(len(stamps), dtype=np.int64)
+    secs[ok] = _to_datetime64([dt for dt in parsed if dt is not None]).view(np.int64)
+    valid = ok[t_inv]
+    if not valid.all():  # drop points whose timestamp doesn't parse
+        pt_codes, pt_labels, pt_units = ([x for x, v in zip(col, valid) if v] for col in (pt_codes, pt_labels, pt_units))
+        if not pt_codes:
+            return []
+    times = secs[t_inv[valid]]
+
+    # --- Group by code in NumPy: count, first/last time and span, without per-code sorts ---
+    uniq, inv, counts = np.unique(np.array(pt_codes), return_inverse=True, return_counts=True)
+    first = np.full(len(uniq), np.iinfo(np.int64).max)
+    last = np.full(len(uniq), np.iinfo(np.int64).min)
+    np.minimum.at(first, inv, times)
+    np.maximum.at(last, inv, times)
+    spans = (last - first) // 86_400
+    keep = (counts >= min_points) & (spans >= min_span_days)
+
+    # Labels/units are tallied only for the codes that passed; a stable sort by group keeps
+    # each group's points in input order, so ties resolve to the first-seen string
+    order = np.argsort(inv, kind="stable")
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    out = []
+    for i in np.flatnonzero(keep):
+        code = str(uniq[i])
+        rows = order[starts[i]:starts[i] + counts[i]]
+        labels = _by_frequency([pt_labels[j] for j in rows if pt_labels[j]])
+        units = _by_frequency([pt_units[j] for j in rows if pt_units[j]])
+        label = labels[0] if labels else f"LOINC {code}"
+        out.append({"code": code, "label": label, "units": units, "count": int(counts[i]), "span_days": int(spans[i])})
 
-    points = defaultdict(list)          # code -> list[(dt, value)]
-    labels = defaultdict(Counter)       # code -> display strings seen
-    units_seen = defaultdict(Counter)   # code -> unit strings seen
+    out.sort(key=lambda d: (-d["count"], d["code"]))
+    return out
 
-    for o in obs:
-        dt = _parse_dt(o)
-        # top-level value
-        vq = o.get("valueQuantity")
-        if vq and "value" in vq:
-            cc = (o.get("code", {}).get("coding") or [{}])[0]
-            code = cc.get("code")
-            if code and dt:
-                points[code].append((dt, vq["value"]))
-                if disp := cc.get("display"): labels[code][disp] += 1
-                unit_txt = vq.get("unit") or vq.get("code") or ""
-                if unit_txt: units_seen[code][unit_txt] += 1
-        # components
-        for comp in o.get("component", []):
-            vqc = comp.get("valueQuantity")
-            if vqc and "value" in vqc:
-                cc = (comp.get("code", {}).get("coding") or [{}])[0]
-                code = cc.get("code")
-                if code and dt:
-                    points[code].append((dt, vqc["value"]))
-                    if disp := cc.get("display"): labels[code][disp] += 1
-                    unit_txt = vqc.get("unit") or vqc.get("code") or ""
-                    if unit_txt: units_seen[code][unit_txt] += 1
+
+@_per_patient
+def get_series_summary_for_patient(pid: str, codes: list[str]) -> list[dict]:
+    """
+    Summarize a patient's Observation series per code from count/first/last probes,
+    without downloading the full history.
+
+    Parameters
+    ----------
+    pid : str
+        Patient ID (with or without 'Patient/' prefix) or identifier such as an MRN
+        (see `resolve_patient_ref`).
+    codes : list of str
+        Observation codes (e.g., LOINC) to summarize. These are matched against
+        `Observation.code`, so component-only codes (e.g. systolic BP inside a
+        BP panel) are not found; probe the panel code instead.
+
+    Returns
+    -------
+    list of dict
+        One item per code with at least one Observation, shaped like the output of
+        `get_chartable_codes_for_patient`:
+          - code: str
+          - label: str
+          - units: list[str]   (seen on the first/last points only)
+          - count: int
+          - span_days: int
+        Sorted by count descending.
+
+    Notes
+    -----
+    - Three tiny requests per code: `_summary=count` for the total, then `_sort=date`
+      and `_sort=-date` with `_count=1` for the first and last points. Transfer size
+      no longer grows with the length of the patient's history.
+    - `_sort=date` orders by `effective[x]`, so `span_days` is measured between the
+      `effectiveDateTime` of the first and last points (0 if either lacks one), unlike
+      `get_chartable_codes_for_patient`, which falls back to `issued`.
+    - `count` is the server total, so it includes any non-numeric Observations for the code.
+    """
+    patient_ref = pid if str(pid).startswith("Patient/") else f"Patient/{pid}"
+    fields = "code,effectiveDateTime,valueQuantity"
 
     out = []
-    for code, pts in points.items():
-        if len(pts) < min_points:
-            continue
-        pts.sort(key=lambda x: x[0])
-        span_days = (pts[-1][0] - pts[0][0]).days if pts[0][0] and pts[-1][0] else 0
-        if span_days < min_span_days:
+    for code in codes:
+        params = {"patient": patient_ref, "code": code}
+        total = fhir_count("Observation", params)
+        if not total:  # none, or the server doesn't report totals
             continue
-        label = (labels[code].most_common(1)[0][0] if labels[code] else f"LOINC {code}")
-        units = [u for u, _ in units_seen[code].most_common()] or []
-        out.append({"code": code, "label": label, "units": units, "count": len(pts), "span_days": span_days})
+        ends = []
+        for sort in ("date", "-date"):
+            js = fhir_get("Observation", params={**params, "_sort": sort, "_count": 1, "_elements": fields})
+            ends.extend(e["resource"] for e in js.get("entry", [])[:1])
+
+        # span from effectiveDateTime only: that is what `_sort=date` orders by
+        dts = _to_datetime64([dt for o in ends if (t := o.get("effectiveDateTime")) and (dt := _parse_iso(t))])
+        span_days = int((dts.max() - dts.min()) // np.timedelta64(1, "D")) if len(dts) else 0
+        cc = ((ends[0].get("code", {}).get("coding") or [{}])[0]) if ends else {}
+        units = []
+        for o in ends:
+            vq = o.get("valueQuantity") or {}
+            if (u := vq.get("unit") or vq.get("code")) and u not in units:
+                units.append(u)
+        out.append({"code": code, "label": cc.get("display") or f"LOINC {code}", "units": units,
+                    "count": total, "span_days": span_days})
 
     out.sort(key=lambda d: (-d["count"], d["code"]))
     return out
 
 
+def identify_chartable_patients(category: str | None = "laboratory",
+                                max_patients: int = 100,
+                                pids: list[str] | None = None,
+                                codes: list[str] | None = None,
+                                categories: list[str] | None = None,
+                                min_points: int = 5,
+                                min_span_days: int = 7,
+                                sample: int = 5000,
+                                only_chartable: bool = False,
+                                max_workers: int = 16) -> dict[str, list[dict]]:
+    """
+    Find patients with chartable Observation series, fetching patients concurrently.
+
+    Parameters
+    ----------
+    category : str or None, default="laboratory"
+        Observation category used to discover candidate patients
+        (see `get_patientids_with_observations`). Ignored if `pids` is given.
+    max_patients : int, default=100
+        Maximum number of candidate patients to discover. Ignored if `pids` is given.
+    pids : list of str or None, default=None
+        Explicit patient IDs (or identifiers such as MRNs) to analyze instead of discovering candidates.
+    codes : list of str or None, default=None
+        If given, screen each patient for just these codes with
+        `get_series_summary_for_patient` (count + first/last probes) instead of
+        downloading their Observations; `categories` and `sample` are then ignored.
+    categories : list[str] or None, default=None
+        Passed through to `get_chartable_codes_for_patient` to restrict fetching.
+    min_points, min_span_days, sample : int
+        Passed through to `get_chartable_codes_for_patient` (`min_points` and
+        `min_span_days` also filter the `codes` screen).
+    only_chartable : bool, default=False
+        Passed through to `get_chartable_codes_for_patient`.
+    max_workers : int, default=16
+        Number of patients fetched in parallel. Keep at or below the session's
+        connection pool size (`pool_maxsize`) so workers don't wait on sockets.
+
+    Returns
+    -------
+    dict[str, list[dict]]
+        Mapping: patient id -> chartable series (as returned by
+        `get_chartable_codes_for_patient`), ordered with the richest patients
+        (most chartable codes, then most points) first.
+
+    Notes
+    -----
+    - Per-patient fetches are network-bound, so a thread pool overlaps the
+      round trips; all workers share the pooled `_SESSION`.
+    """
+    # Discovered ids come straight from the server, so they skip the identifier fallback
+    discovered = pids is None
+    if discovered:
+        pids = get_patientids_with_observations(category, max_patients=max_patients)
+
+    def _screen(pid):
+        ref = f"Patient/{pid}" if discovered else pid
+        if codes:
+            return [d for d in get_series_summary_for_patient(ref, codes)
+                    if d["count"] >= min_points and d["span_days"] >= min_span_days]
+        return get_chartable_codes_for_patient(ref,
+                                               min_points=min_points,
+                                               min_span_days=min_span_days,
+                                               sample=sample,
+                                               categories=categories,
+                                               only_chartable=only_chartable)
+
+    results: dict[str, list[dict]] = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        futures = {ex.submit(_screen, pid): pid for pid in pids}
+        for fut in as_completed(futures):
+            results[futures[fut]] = fut.result()
+
+    ranked = sorted(results.items(),
+                    key=lambda kv: (-len(kv[1]), -sum(d["count"] for d in kv[1]), kv[0]))
+    return dict(ranked)
+
+
+
 
 BP_SBP = "8480-6"   # Systolic
 BP_DBP = "8462-4"   # Diastolic
 
-LIPIDS   = {"2093-3","2085-9","18262-6","2571-8"}
-BMP_LIKE = {"2339-0","2947-0","6298-4","2069-3","20565-8","6299-2","38483-4","49765-1"}
-LIVER    = {"1742-6","1920-8","6768-6","1975-2","1751-7","2885-2","10834-0"}
-RENAL    = {"38483-4","33914-3"}  # keep special handling below
-VITALS   = {"8867-4","9279-1","8302-2","29463-7","39156-5"}
+LIPIDS   = frozenset({"2093-3","2085-9","18262-6","2571-8"})
+BMP_LIKE = frozenset({"2339-0","2947-0","6298-4","2069-3","20565-8","6299-2","38483-4","49765-1"})
+LIVER    = frozenset({"1742-6","1920-8","6768-6","1975-2","1751-7","2885-2","10834-0"})
+RENAL    = frozenset({"38483-4","33914-3"})  # creatinine is charted with the BMP
+VITALS   = frozenset({"8867-4","9279-1","8302-2","29463-7","39156-5"})
 
 # Survey / SDOH / PRO codes (expand as needed)
-SURVEYS  = {"72514-3","55758-7","70274-6","76504-0","63512-8","63586-2","59460-6"}
+SURVEYS  = frozenset({"72514-3","55758-7","70274-6","76504-0","63512-8","63586-2","59460-6"})
+
+# Codes worth fetching when only known series are wanted (server-side `code=` filter).
+# SBP/DBP usually arrive as components, so the BP panel codes from SIGNAL_MAP must be included
+CHARTABLE_CODES = (LIPIDS | BMP_LIKE | LIVER | RENAL | VITALS | SURVEYS | {BP_SBP, BP_DBP}
+                   | {c for v in SIGNAL_MAP.values() for c in v.get("codes", ())})
+
+# Fixed chart titles per code, in the order their charts are emitted
+_VITAL_TITLES = {
+    "8867-4": "Heart Rate (/min)",
+    "9279-1": "Respiratory Rate (/min)",
+    "8302-2": "Height (cm)",
+    "29463-7": "Weight (kg)",
+    "39156-5": "BMI (kg/m²)",
+}
+_LIPID_TITLES = {
+    "2093-3": "Cholesterol (mg/dL)",
+    "2085-9": "HDL (mg/dL)",
+    "18262-6": "LDL (mg/dL)",
+    "2571-8": "Triglycerides (mg/dL)",
+}
+_BMP_TITLES = {
+    "2339-0": "Glucose (mg/dL)",
+    "2947-0": "Sodium (mmol/L)",
+    "6298-4": "Potassium (mmol/L)",
+    "2069-3": "Chloride (mmol/L)",
+    "20565-8": "CO₂ (mmol/L)",
+    "6299-2": "BUN (mg/dL)",
+    "38483-4": "Creatinine (mg/dL)",
+    "49765-1": "Calcium (mg/dL)",
+}
+_RENAL_TITLES = {
+    "33914-3": "eGFR (mL/min/1.73m²)",  # creatinine is already charted with the BMP
+}
+_LIVER_TITLES = {
+    "1742-6": "ALT (U/L)",
+    "1920-8": "AST (U/L)",
+    "6768-6": "ALP (U/L)",
+    "1975-2": "Bilirubin (mg/dL)",
+    "1751-7": "Albumin (g/dL)",
+    "2885-2": "Total Protein (g/dL)",
+    "10834-0": "Globulin (g/L)",
+}
+_SURVEY_TITLES = {
+    "72514-3": "Pain score (0–10)",
+    "55758-7": "PHQ-2 total",
+    "70274-6": "GAD-7 total",
+    "76504-0": "HARK total",
+    "63512-8": "Household size",
+    "63586-2": "Household income (per annum)",
+    "59460-6": "Morse fall risk total",
+}
+_BP_PAIR = frozenset({BP_SBP, BP_DBP})
+_CODE_TITLE = {**_VITAL_TITLES, **_LIPID_TITLES, **_BMP_TITLES, **_RENAL_TITLES, **_LIVER_TITLES}
+_ALL_TITLES = {**_CODE_TITLE, **_SURVEY_TITLES}
+_CODE_RANK = {code: i for i, code in enumerate(_ALL_TITLES)}
+
 
 def group_chartables(chartable_list, include_surveys: bool = False):
     """
@@ -485,101 +1191,42 @@ def group_chartables(chartable_list, include_surveys: bool = False):
     dict[str, list[dict]]
         Mapping of chart title -> list of series dicts.
     """
-    by_code = {d["code"]: d for d in chartable_list}
+    # One pass: route each series to the BP pair, a fixed-title chart, or the generic charts
+    titles = _ALL_TITLES if include_surveys else _CODE_TITLE
+    bp = {}
+    titled = {}
+    rest = []
+    for d in chartable_list:
+        c = d["code"]
+        if c in _BP_PAIR:
+            bp[c] = d
+        elif c in titles:
+            titled[c] = d
+        else:
+            rest.append(d)
 
-    groups = defaultdict(list)
-    used_codes = set()
+    groups = {}
 
     # 1) Blood pressure (combine)
-    if BP_SBP in by_code and BP_DBP in by_code:
-        groups["Blood Pressure (mmHg)"] += [by_code[BP_SBP], by_code[BP_DBP]]
-        used_codes.update({BP_SBP, BP_DBP})
+    if len(bp) == 2:
+        groups["Blood Pressure (mmHg)"] = [bp[BP_SBP], bp[BP_DBP]]
     else:
-        if BP_SBP in by_code:
-            groups["BP (Systolic)"].append(by_code[BP_SBP]); used_codes.add(BP_SBP)
-        if BP_DBP in by_code:
-            groups["BP (Diastolic)"].append(by_code[BP_DBP]); used_codes.add(BP_DBP)
-
-    # 2) Vitals (separate)
-    vit_titles = {
-        "8867-4": "Heart Rate (/min)",
-        "9279-1": "Respiratory Rate (/min)",
-        "8302-2": "Height (cm)",
-        "29463-7": "Weight (kg)",
-        "39156-5": "BMI (kg/m²)",
-    }
-    for code, title in vit_titles.items():
-        if code in by_code:
-            groups[title].append(by_code[code]); used_codes.add(code)
-
-    # 3) Lipids (separate)
-    lipid_titles = {
-        "2093-3": "Cholesterol (mg/dL)",
-        "2085-9": "HDL (mg/dL)",
-        "18262-6": "LDL (mg/dL)",
-        "2571-8": "Triglycerides (mg/dL)",
-    }
-    for code, title in lipid_titles.items():
-        if code in by_code:
-            groups[title].append(by_code[code]); used_codes.add(code)
-
-    # 4) BMP-like chemistries (separate)
-    bmp_titles = {
-        "2339-0": "Glucose (mg/dL)",
-        "2947-0": "Sodium (mmol/L)",
-        "6298-4": "Potassium (mmol/L)",
-        "2069-3": "Chloride (mmol/L)",
-        "20565-8": "CO₂ (mmol/L)",
-        "6299-2": "BUN (mg/dL)",
-        "38483-4": "Creatinine (mg/dL)",
-        "49765-1": "Calcium (mg/dL)",
-    }
-    for code, title in bmp_titles.items():
-        if code in by_code and code not in used_codes:
-            groups[title].append(by_code[code]); used_codes.add(code)
-
-    # 5) Renal function (don’t duplicate creatinine if already placed)
-    if "38483-4" in by_code and "38483-4" not in used_codes:
-        groups["Creatinine (mg/dL)"].append(by_code["38483-4"]); used_codes.add("38483-4")
-    if "33914-3" in by_code:
-        groups["eGFR (mL/min/1.73m²)"].append(by_code["33914-3"]); used_codes.add("33914-3")
-
-    # 6) Liver panel (separate)
-    liver_titles = {
-        "1742-6": "ALT (U/L)",
-        "1920-8": "AST (U/L)",
-        "6768-6": "ALP (U/L)",
-        "1975-2": "Bilirubin (mg/dL)",
-        "1751-7": "Albumin (g/dL)",
-        "2885-2": "Total Protein (g/dL)",
-        "10834-0": "Globulin (g/L)",
-    }
-    for code, title in liver_titles.items():
-        if code in by_code and code not in used_codes:
-            groups[title].append(by_code[code]); used_codes.add(code)
-
-    # 7) Surveys/PRO/SDOH (optional)
-    if include_surveys:
-        survey_titles = {
-            "72514-3": "Pain score (0–10)",
-            "55758-7": "PHQ-2 total",
-            "70274-6": "GAD-7 total",
-            "76504-0": "HARK total",
-            "63512-8": "Household size",
-            "63586-2": "Household income (per annum)",
-            "59460-6": "Morse fall risk total",
-        }
-        for code, title in survey_titles.items():
-            if code in by_code and code not in used_codes:
-                groups[title].append(by_code[code]); used_codes.add(code)
-
-    # 8) Anything else → one chart per code
-    for d in chartable_list:
+        if BP_SBP in bp:
+            groups["BP (Systolic)"] = [bp[BP_SBP]]
+        if BP_DBP in bp:
+            groups["BP (Diastolic)"] = [bp[BP_DBP]]
+
+    # 2) Vitals, lipids, BMP, renal, liver, surveys (optional): one chart each, in table order
+    for c in sorted(titled, key=_CODE_RANK.__getitem__):
+        groups[titles[c]] = [titled[c]]
+
+    # 3) Anything else → one chart per code
+    seen = set()
+    for d in rest:
         c = d["code"]
-        if c not in used_codes:
+        if c not in seen:
             unit = f" ({d['units'][0]})" if d.get("units") else ""
-            groups[f"{d['label']}{unit}"].append(d)
-            used_codes.add(c)
-
-    return dict(groups)
+            groups.setdefault(f"{d['label']}{unit}", []).append(d)
+            seen.add(c)
 
+    return groups